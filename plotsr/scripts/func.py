@@ -1,5 +1,6 @@
 import sys
 import logging
+from functools import lru_cache
 import matplotlib.font_manager
 # Constants
 MARKERS = {".": "point",
@@ -49,6 +50,8 @@ for fn in matplotlib.font_manager.findSystemFonts():
     except RuntimeError:
         pass
 FONT_NAMES = sorted(set(FONT_NAMES))
+# Minimum number of alignments for which the numba kernels are used (when numba is installed)
+NUMBA_MINROWS = 1000000
 
 
 '''
@@ -184,6 +187,70 @@ DEFINE READERS/PARSERS
 """
 
 
+@lru_cache(maxsize=None)
+def _numbakernels():
+    """
+    Import numba and compile the parallel kernels for lenfilter and invswap.
+    Called only for inputs with at least NUMBA_MINROWS alignments, so that numba is not imported otherwise.
+    :return: (lenfilter kernel, invswap kernel) or None when numba is not installed
+    """
+    try:
+        import numba
+    except ImportError:
+        return None
+    import numpy as np
+
+    @numba.njit(parallel=True, cache=True)
+    def lenfilter_numba(astart, aend, bstart, bend, tcode, minlen, syncode):
+        keep = np.empty(astart.shape[0], dtype=np.bool_)
+        for i in numba.prange(astart.shape[0]):
+            keep[i] = (aend[i] - astart[i]) >= minlen or (bend[i] - bstart[i]) >= minlen or tcode[i] == syncode
+        return keep
+    # END
+
+    @numba.njit(parallel=True, cache=True)
+    def invswap_numba(bstart, bend, invindex):
+        bs = bstart.copy()
+        be = bend.copy()
+        for i in numba.prange(bstart.shape[0]):
+            if invindex[i]:
+                bs[i] = bend[i]
+                be[i] = bstart[i]
+        return bs, be
+    # END
+    return lenfilter_numba, invswap_numba
+# END
+
+
+def lenfilter(astart, aend, bstart, bend, tcode, minlen):
+    """
+    Get mask for alignments that are longer than minlen in either genome or are syntenic.
+    :param tcode: category codes of the annotation types (indices in VARS)
+    :return: boolean numpy array
+    """
+    syncode = VARS.index('SYN')
+    if astart.shape[0] >= NUMBA_MINROWS:
+        kernels = _numbakernels()
+        if kernels is not None:
+            return kernels[0](astart, aend, bstart, bend, tcode, minlen, syncode)
+    return ((aend - astart) >= minlen) | ((bend - bstart) >= minlen) | (tcode == syncode)
+# END
+
+
+def invswap(bstart, bend, invindex):
+    """
+    Swap bstart and bend coordinates for alignments selected by invindex.
+    :return: swapped bstart and bend numpy arrays
+    """
+    import numpy as np
+    if bstart.shape[0] >= NUMBA_MINROWS:
+        kernels = _numbakernels()
+        if kernels is not None:
+            return kernels[1](bstart, bend, invindex)
+    return np.where(invindex, bend, bstart), np.where(invindex, bstart, bend)
+# END
+
+
 def readbasecfg(f, v):
     import logging
     import matplotlib
@@ -441,41 +508,53 @@ def readannobed(path, v, chrlengths):
 
 
 def readsyriout(f):
-    from pandas import DataFrame
+    from pandas import read_csv, CategoricalDtype
     import numpy as np
+    import csv
+    from io import StringIO
     from collections import deque, OrderedDict
     import logging
     # Reads syri.out. Select: achr, astart, aend, bchr, bstart, bend, srtype
     logger = logging.getLogger("readsyriout")
     syri_regs = deque()
+    extracol = False
     skipvartype = ['CPG', 'CPL', 'DEL', 'DUPAL', 'HDR', 'INS', 'INVAL', 'INVDPAL', 'INVTRAL', 'NOTAL', 'SNP', 'SYNAL', 'TDM', 'TRANSAL']
     logger.info('Reading input files generated by syri.')
     with open(f, 'r') as fin:
         for line in fin:
-            l = line.strip().split()
+            try:
+                vt = line.split(None, 11)[10]
+            except IndexError:
+                raise ImportError("Incomplete input file {}, syri.out file should have 11 columns.".format(f))
             # TODO: DECIDE WHETHER TO HAVE STATIC VARS OR FLEXIBLE ANNOTATION
-            if l[10] in VARS:
-                syri_regs.append(l)
+            if vt in VARS:
+                # Lines with columns beyond the annotation column are cut to the first 13 fields
+                l = line.split(None, 13)
+                if len(l) > 13:
+                    extracol = True
+                    line = '\t'.join(l[:13]) + '\n'
+                syri_regs.append(line)
             else:
-                if l[10] not in skipvartype:
-                    skipvartype.append(l[10])
-                    logger.warning("{} is not a valid annotation for alignments in file {}. Alignments should belong to the following classes {}. Skipping alignment.".format(l[10], f, VARS))
+                if vt not in skipvartype:
+                    skipvartype.append(vt)
+                    logger.warning("{} is not a valid annotation for alignments in file {}. Alignments should belong to the following classes {}. Skipping alignment.".format(vt, f, VARS))
+    # Selected lines are tokenised and converted by the C parser. Missing annotation column is read as empty string
+    # Annotation types are stored as categorical with VARS as categories, so that category codes are indices in VARS
     try:
-        df = DataFrame(list(syri_regs))
-    except KeyError:
-        raise ImportError("Incomplete input file {}, syri.out file should have 11 columns.".format(f))
-    if df.shape[1] == 13:
+        df = read_csv(StringIO(''.join(syri_regs)), sep=r'\s+', header=None, names=list(range(13)), dtype={0: str, 1: int, 2: int, 5: str, 6: int, 7: int, 10: CategoricalDtype(VARS), 12: str}, na_filter=False, quoting=csv.QUOTE_NONE, engine='c')
+    except ValueError:
+        raise ValueError("Non-numerical values used as genome coordinates in {}. Exiting".format(f))
+    df = df[[0, 1, 2, 5, 6, 7, 10, 12]]
+    if extracol:
+        logger.warning(f'{f} has more than 13 columns. Extra columns are ignored and default values are used for alignment customisation.')
+        df[12] = '-'
+    elif (df[12] != '').any():
         logger.warning(f'{f} has an extra annotation column dedicated for alignment customisation. Using it.')
+        df.loc[df[12] == '', 12] = '-'
     else:
         logger.info(f'{f} does not have an extra annotation column dedicated for alignment customisation. Using default values.')
         df[12] = '-'
-    df = df[[0, 1, 2, 5, 6, 7, 10, 12]]
     colnames = ['achr', 'astart', 'aend', 'bchr', 'bstart', 'bend',  'type', 'anno']
-    df[[0, 5, 10]] = df[[0, 5, 10]].astype(str)
-    try:
-        df[[1, 2, 6, 7]] = df[[1, 2, 6, 7]].astype(int)
-    except ValueError:
-        raise ValueError("Non-numerical values used as genome coordinates in {}. Exiting".format(f))
     # chr ID map
     chrid = []
     chrid_dict = OrderedDict()
@@ -488,41 +567,51 @@ def readsyriout(f):
 
 
 def readbedout(f):
-    from pandas import DataFrame
+    from pandas import read_csv, CategoricalDtype
     import numpy as np
+    import csv
+    from io import StringIO
     from collections import deque, OrderedDict
     import logging
     # BEDPE format: achr, astart, aend, bchr, bstart, bend, srtype
     logger = logging.getLogger('readbedout')
     bed_regs = deque()
+    extracol = False
     skipvartype = []
     with open(f, 'r') as fin:
         for line in fin:
-            l = line.strip().split()
+            try:
+                vt = line.split(None, 7)[6]
+            except IndexError:
+                raise ImportError("Incomplete input file {}, BEDPE file should have 7 columns.".format(f))
             # TODO: DECIDE WHETHER TO HAVE STATIC VARS OR FLEXIBLE ANNOTATION
-            if l[6] in VARS:
-                bed_regs.append(l)
+            if vt in VARS:
+                # Lines with columns beyond the annotation column are cut to the first 8 fields
+                l = line.split(None, 8)
+                if len(l) > 8:
+                    extracol = True
+                    line = '\t'.join(l[:8]) + '\n'
+                bed_regs.append(line)
             else:
-                if l[6] not in skipvartype:
-                    skipvartype.append(l[6])
-                    logger.warning("{} is not a valid annotation for alignments in file {}. Alignments should belong to the following classes {}. Skipping alignment.".format(l[6], f, VARS))
-
-    df = DataFrame(list(bed_regs))
-    if df.shape[1] == 8:
+                if vt not in skipvartype:
+                    skipvartype.append(vt)
+                    logger.warning("{} is not a valid annotation for alignments in file {}. Alignments should belong to the following classes {}. Skipping alignment.".format(vt, f, VARS))
+    # Selected lines are tokenised and converted by the C parser. Missing annotation column is read as empty string
+    # Annotation types are stored as categorical with VARS as categories, so that category codes are indices in VARS
+    try:
+        df = read_csv(StringIO(''.join(bed_regs)), sep=r'\s+', header=None, names=list(range(8)), dtype={0: str, 1: int, 2: int, 3: str, 4: int, 5: int, 6: CategoricalDtype(VARS), 7: str}, na_filter=False, quoting=csv.QUOTE_NONE, engine='c')
+    except ValueError:
+        raise ValueError("Non-numerical values used as genome coordinates in {}. Exiting".format(f))
+    if extracol:
+        logger.warning(f'{f} has more than 8 columns. Extra columns are ignored and default values are used for alignment customisation.')
+        df[7] = '-'
+    elif (df[7] != '').any():
         logger.warning(f'{f} have extra annotation column dedicated for alignment customisation. Using it.')
+        df.loc[df[7] == '', 7] = '-'
     else:
         logger.warning(f'{f} does have extra annotation column dedicated for alignment customisation. Using default values.')
         df[7] = '-'
     colnames = ['achr', 'astart', 'aend', 'bchr', 'bstart', 'bend',  'type', 'anno']
-    try:
-        df[[0, 3, 6]] = df[[0, 3, 6]].astype(str)
-    except KeyError:
-        raise ImportError("Incomplete input file {}, BEDPE file should have 7 columns.".format(f))
-    try:
-        df[[1, 2, 4, 5]] = df[[1, 2, 4, 5]].astype(int)
-    except ValueError:
-        raise ValueError("Non-numerical values used as genome coordinates in {}. Exiting".format(f))
-    df[[1, 2, 4, 5]] = df[[1, 2, 4, 5]].astype(int)
     df[[1, 4]] = df[[1, 4]] + 1 # Makes range closed as the terminal bases are also included
     # chr ID map
     chrid = []
@@ -1112,31 +1201,46 @@ def validalign2fasta(als, genf):
 # END
 
 
-def filterinput(args, df, chrid, itx=False):
+def filterinput(args, alignments, chrids, itx=False):
+    """
+    Select long alignments between homologous chromosomes. Alignments from all
+    input files are filtered together in a single pass.
+    :param alignments: list; each element is a list of [filename, alignment dataframe]
+    :param chrids: list; each element is a tuple of (filename, dict of homologous chromosome IDs)
+    :return: list of filtered dataframes in the same order as alignments
+    """
+    from pandas import concat, MultiIndex, Series
+    df = concat([al[1].assign(src=i) for i, al in enumerate(alignments)])
     # Get region length and filter out smaller SR
-    df = df.loc[((df['aend'] - df['astart']) >= args.s) | ((df['bend'] - df['bstart']) >= args.s) | (df['type'] == 'SYN')].copy()
+    keep = lenfilter(df['astart'].to_numpy(), df['aend'].to_numpy(), df['bstart'].to_numpy(), df['bend'].to_numpy(), df['type'].cat.codes.to_numpy(), args.s)
     if not itx:
-        df = df.loc[df['bchr'] == [chrid[i] for i in df['achr']]]
+        homchr = Series({(i, k): v for i, cid in enumerate(chrids) for k, v in cid[1].items()})
+        homchr = homchr.reindex(MultiIndex.from_arrays([df['src'], df['achr']])).to_numpy()
+        keep &= df['bchr'].to_numpy() == homchr
     # Filter non-selected variations
     if args.nosyn:
-        df = df.loc[df['type'] != 'SYN']
+        keep &= (df['type'] != 'SYN').to_numpy()
     if args.noinv:
-        df = df.loc[df['type'] != 'INV']
+        keep &= (df['type'] != 'INV').to_numpy()
     if args.notr:
-        df = df.loc[~df['type'].isin(['TRANS', 'INVTR'])]
+        keep &= (~df['type'].isin(['TRANS', 'INVTR'])).to_numpy()
     if args.nodup:
-        df = df.loc[~df['type'].isin(['DUP', 'INVDP'])]
-    df.sort_values(['bchr', 'bstart', 'bend'], inplace=True)
-    df.sort_values(['achr', 'astart', 'aend'], inplace=True)
-    return df
+        keep &= (~df['type'].isin(['DUP', 'INVDP'])).to_numpy()
+    df = df.loc[keep]
+    df = df.sort_values(['src', 'bchr', 'bstart', 'bend'])
+    df.sort_values(['src', 'achr', 'astart', 'aend'], inplace=True)
+    # Split back to per-file alignments
+    groups = dict(tuple(df.groupby('src', sort=False)))
+    empty = df.iloc[0:0]
+    return [groups.get(i, empty).drop(columns='src') for i in range(len(alignments))]
 # END
 
 
 def selectchrom(CHRS, cs, chrgrps, alignments, chrlengths, chrids):
     import logging
-    from collections import deque, OrderedDict
-    homchrs = deque()
-    chrs = deque()
+    from collections import OrderedDict
+    homchrs = []
+    chrs = []
     logger = logging.getLogger("Selecting chromosomes")
     for c in CHRS:
         if c not in cs:
@@ -1158,13 +1262,13 @@ def selectchrom(CHRS, cs, chrgrps, alignments, chrlengths, chrids):
         # Update groups of homologous chromosomes
         # chrs = [k for k in chrids[0][1].keys() if k in alignments[0][1]['achr'].unique()]
         chrgrps = OrderedDict()
+        chrmaps = [cid[1] for cid in chrids]
         for c in chrs:
-            cg = deque([c])
+            cg = [c]
             cur = c
-            for i in range(len(chrids)):
-                n = chrids[i][1][cur]
-                cg.append(n)
-                cur = n
+            for m in chrmaps:
+                cur = m[cur]
+                cg.append(cur)
             chrgrps[c] = cg
     return alignments, chrs, chrgrps, chrlengths
 # END
@@ -1173,7 +1277,7 @@ def selectchrom(CHRS, cs, chrgrps, alignments, chrlengths, chrids):
 def selectregion(reg, rtr, chrlengths, al, chrids):
     import pandas as pd
     import copy
-    from collections import OrderedDict, deque
+    from collections import OrderedDict
     alignments = copy.deepcopy(al)
     genids = [i[0] for i in chrlengths]
     if len(reg) != 3:
@@ -1309,13 +1413,13 @@ def selectregion(reg, rtr, chrlengths, al, chrids):
             alignments[i][1] = tmp
     chrs = [k for k in chrids[0][1].keys() if k in alignments[0][1]['achr'].unique()]
     chrgrps = OrderedDict()
+    chrmaps = [cid[1] for cid in chrids]
     for c in chrs:
-        cg = deque([c])
+        cg = [c]
         cur = c
-        for i in range(len(chrids)):
-            n = chrids[i][1][cur]
-            cg.append(n)
-            cur = n
+        for m in chrmaps:
+            cur = m[cur]
+            cg.append(cur)
         chrgrps[c] = cg
     return alignments, chrs, chrgrps
 # END
@@ -1386,6 +1490,7 @@ def createribbon(df):
     newsyn = DataFrame(list(newsyn), columns=['achr', 'astart', 'aend', 'bchr', 'bstart', 'bend'])
     newsyn['anno'] = '-'
     newsyn['type'] = 'SYN'
+    newsyn['type'] = newsyn['type'].astype(df['type'].dtype)
 
     df = df.drop(['a', 'b'], axis=1)
     df = df.loc[-(df['type'] == 'SYN')]
@@ -1649,8 +1754,11 @@ def pltchrom(ax, chrs, chrgrps, chrlengths, v, S, genomes, cfg, itx, chr_start_c
 
 
 def pltsv(ax, alignments, chrs, v, chrgrps, chrlengths, indents, S, cfg, itx, chr_start_coord):
-    from collections import deque
+    from collections import deque, OrderedDict
     from copy import deepcopy
+    from matplotlib import collections as mc
+    import matplotlib.patches as patches
+    from matplotlib.path import Path
     def annotodict(anno):
         return {a.split(':')[0]: a.split(':')[1] for a in anno.split(';')}
     #END
@@ -1661,6 +1769,8 @@ def pltsv(ax, alignments, chrs, v, chrgrps, chrlengths, indents, S, cfg, itx, ch
     adduplab = False
     svlabels = dict()
     legenddict = {'SYN': adsynlab, 'INV': adinvlab, 'TRANS': adtralab, 'DUP': adduplab}
+    # Annotations are drawn as one collection per zorder instead of one patch per annotation
+    svpaths = OrderedDict()
     for s in range(len(alignments)):
         df = deepcopy(alignments[s][1])
         df.loc[df['type'] == 'INVTR', 'type'] = 'TRANS'
@@ -1711,13 +1821,6 @@ def pltsv(ax, alignments, chrs, v, chrgrps, chrlengths, indents, S, cfg, itx, ch
                 offset = i if not v else -i
                 df.loc[df['achr'] == chrgrps[chrs[i]][s], 'ry'] -= offset
                 df.loc[df['achr'] == chrgrps[chrs[i]][s], 'qy'] -= offset
-            for row in df.itertuples(index=False):
-                p = bezierpath(row.astart, row.aend, row.bstart, row.bend, row.ry, row.qy, v, row.col, alpha=alpha, label=row.lab, lw=row.lw, zorder=row.zorder)
-                l = ax.add_patch(p)
-                if row.lab != '':
-                    if not legenddict[row.type]:
-                        svlabels[row.type] = l
-                        legenddict[row.type] = True
         elif itx:
             step = S/(len(chrlengths)-1)
             S - (step*s) if not v else 1 - S + (step*s)
@@ -1731,45 +1834,39 @@ def pltsv(ax, alignments, chrs, v, chrgrps, chrlengths, indents, S, cfg, itx, ch
             df['bend'] += qbuff
             df['ry'] = S - (step*s) if not v else 1 - S + (step*s) # len(chrlengths) - s - 0.5 if not v else s + 0.5
             df['qy'] = S - (step*(s+1)) if not v else 1 - S + (step*(s+1)) # len(chrlengths) - s - 1 - 0.5 if not v else s + 1 + 0.5
-            for row in df.itertuples(index=False):
-                p = bezierpath(row.astart, row.aend, row.bstart, row.bend, row.ry, row.qy, v, row.col, alpha=alpha, label=row.lab, lw=row.lw, zorder=row.zorder)
-                l = ax.add_patch(p)
-                if row.lab != '':
-                    if not legenddict[row.type]:
-                        svlabels[row.type] = l
-                        legenddict[row.type] = True
+        verts, codes = bezierverts(df['astart'].to_numpy(), df['aend'].to_numpy(), df['bstart'].to_numpy(), df['bend'].to_numpy(), df['ry'].to_numpy(), df['qy'].to_numpy(), v)
+        for row, vert in zip(df.itertuples(index=False), verts):
+            if row.zorder not in svpaths:
+                svpaths[row.zorder] = ([], [], [])
+            svpaths[row.zorder][0].append(Path(vert, codes))
+            svpaths[row.zorder][1].append(row.col)
+            svpaths[row.zorder][2].append(row.lw)
+            if row.lab != '':
+                if not legenddict[row.type]:
+                    svlabels[row.type] = patches.Patch(facecolor=row.col, lw=row.lw, alpha=alpha, label=row.lab, edgecolor=row.col)
+                    legenddict[row.type] = True
+    for z, (paths, cols, lws) in svpaths.items():
+        ax.add_collection(mc.PathCollection(paths, facecolors=cols, edgecolors=cols, linewidths=lws, alpha=alpha, zorder=z), autolim=False)
     return ax, [svlabels[i] for i in ['SYN', 'INV', 'TRANS', 'DUP'] if i in svlabels]
 # END
 
 
-def bezierpath(rs, re, qs, qe, ry, qy, v, col, alpha, label='', lw=0, zorder=0):
-    import matplotlib.patches as patches
+def bezierverts(rs, re, qs, qe, ry, qy, v):
+    """
+    Get vertices and codes of the bezier paths connecting reference and query
+    regions. Coordinates can be scalars or numpy arrays of equal length.
+    :return: vertices array with shape (..., 9, 2) and the list of path codes
+    """
+    import numpy as np
     from matplotlib.path import Path
     smid = (qs-rs)/2    # Start increment
     emid = (qe-re)/2    # End increment
     hmid = (qy-ry)/2    # Heinght increment
-    if not v:
-        verts = [(rs, ry),
-                 (rs, ry+hmid),
-                 (rs+2*smid, ry+hmid),
-                 (rs+2*smid, ry+2*hmid),
-                 (qe, qy),
-                 (qe, qy-hmid),
-                 (qe-2*emid, qy-hmid),
-                 (qe-2*emid, qy-2*hmid),
-                 (rs, ry),
-                 ]
-    else:
-        verts = [(ry, rs),
-                 (ry+hmid, rs),
-                 (ry+hmid, rs+2*smid),
-                 (ry+2*hmid, rs+2*smid),
-                 (qy, qe),
-                 (qy-hmid, qe),
-                 (qy-hmid, qe-2*emid),
-                 (qy-2*hmid, qe-2*emid),
-                 (ry, rs),
-                 ]
+    x = [rs, rs, rs+2*smid, rs+2*smid, qe, qe, qe-2*emid, qe-2*emid, rs]
+    y = [ry, ry+hmid, ry+hmid, ry+2*hmid, qy, qy-hmid, qy-hmid, qy-2*hmid, ry]
+    x = np.stack(np.broadcast_arrays(*x), axis=-1)
+    y = np.stack(np.broadcast_arrays(*y), axis=-1)
+    verts = np.stack([x, y], axis=-1) if not v else np.stack([y, x], axis=-1)
     codes = [
         Path.MOVETO,
         Path.CURVE4,
@@ -1781,6 +1878,14 @@ def bezierpath(rs, re, qs, qe, ry, qy, v, col, alpha, label='', lw=0, zorder=0):
         Path.CURVE4,
         Path.CLOSEPOLY,
     ]
+    return verts, codes
+# END
+
+
+def bezierpath(rs, re, qs, qe, ry, qy, v, col, alpha, label='', lw=0, zorder=0):
+    import matplotlib.patches as patches
+    from matplotlib.path import Path
+    verts, codes = bezierverts(rs, re, qs, qe, ry, qy, v)
     path = Path(verts, codes)
     patch = patches.PathPatch(path, facecolor=col, lw=lw, alpha=alpha, label=label, edgecolor=col, zorder=zorder)
     return patch
@@ -11,15 +11,36 @@ Description: Plotting multi genome structural annotations
 import argparse
 from plotsr import __version__
 
+
+class LazyBackends():
+    """
+    Choices for the matplotlib backend. The list of backends is loaded from
+    matplotlib on first use, so that --version does not import matplotlib.
+    """
+    def _backends(self):
+        from matplotlib.rcsetup import non_interactive_bk
+        return non_interactive_bk
+
+    def __contains__(self, b):
+        return b in self._backends()
+
+    def __iter__(self):
+        return iter(self._backends())
+# END
+
+
 def plotsr(args):
     import logging
     from pandas import concat as pdconcat
-    from pandas import unique
-    from plotsr.scripts.func import setlogconfig, readbasecfg, readsyriout, readbedout, filterinput, validalign2fasta, selectchrom, selectregion, createribbon, drawax, genbuff, pltchrom, pltsv, drawmarkers, readtrack, drawtracks, getfilehandler, definelogger
-    from collections import deque, OrderedDict
+    from pandas import read_csv
+    from pandas.errors import EmptyDataError, ParserError
+    import csv
+    from plotsr.scripts.func import VARS, invswap, setlogconfig, readbasecfg, readsyriout, readbedout, filterinput, validalign2fasta, selectchrom, selectregion, createribbon, drawax, genbuff, pltchrom, pltsv, drawmarkers, readtrack, drawtracks, getfilehandler, definelogger
+    from collections import OrderedDict
+    from concurrent.futures import ProcessPoolExecutor
     import os
     from math import ceil
-    import matplotlib
+    import numpy as np
     import sys
 
     ## Define loggers
@@ -104,6 +125,7 @@ def plotsr(args):
         O = O.rsplit(".", 1)[0] + ".pdf"
 
     ## Set matplotlib backend
+    import matplotlib
     try :
         matplotlib.use(args.b)
         # matplotlib.use('Qt5Agg')    # TODO: Delete this line
@@ -111,35 +133,47 @@ def plotsr(args):
         sys.exit('Matplotlib backend cannot be selected. Exiting.')
 
     # Read alignment coords; format: ([['genome1_genome2.out', al_a], ['genome2_genome3.out', al_b], ...])
-    alignments = deque()
-    chrids = deque()
-    if args.sr is not None:
-        for f in args.sr:
-            fin = f.name
-            al, cid = readsyriout(fin)
-            alignments.append([os.path.basename(fin), al])
-            chrids.append((os.path.basename(fin), cid))
-    elif args.bp is not None:
-        for f in args.bp:
-            fin = f.name
-            al, cid = readbedout(fin)
-            alignments.append([os.path.basename(fin), al])
-            chrids.append((os.path.basename(fin), cid))
+    # Input files are independent, so they are parsed in parallel when more than one file is provided
+    readfun = readsyriout if args.sr is not None else readbedout
+    fins = [f.name for f in (args.sr if args.sr is not None else args.bp)]
+    # Number of CPUs available to this process (respects CPU affinity where supported)
+    ncpu = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    nworkers = min(len(fins), ncpu)
+    if nworkers > 1:
+        with ProcessPoolExecutor(max_workers=nworkers, initializer=setlogconfig, initargs=(args.log,)) as executor:
+            results = list(executor.map(readfun, fins))
+    else:
+        results = [readfun(fin) for fin in fins]
+    alignments = []
+    chrids = []
+    for fin, (al, cid) in zip(fins, results):
+        alignments.append([os.path.basename(fin), al])
+        chrids.append((os.path.basename(fin), cid))
 
     # Get groups of homologous chromosomes, using the order from the user if provided
-    cs = set(unique(alignments[0][1]['achr']))
+    cs = set(alignments[0][1]['achr'].unique())
     if args.chrord is None:
-        chrs = [k for k in chrids[0][1].keys() if k in alignments[0][1]['achr'].unique()]
+        chrs = [k for k in chrids[0][1] if k in cs]
     else:
-        chrs = deque()
-        with open(args.chrord.name, 'r') as fin:
-            for line in fin:
-                c = line.strip()
-                if c not in cs:
-                    logger.error("Chromosome {} in {} is not a chromosome in alignment file {}. Exiting.".format(c, args.chrord.name, alignments[0][0]))
-                    sys.exit()
-                chrs.append(c)
-        chrs = list(chrs)
+        try:
+            df = read_csv(args.chrord.name, sep=r'\s+', header=None, dtype=str, na_filter=False, quoting=csv.QUOTE_NONE, engine='c')
+            multifield = df.shape[1] > 1
+        except EmptyDataError:
+            df, multifield = None, False
+        except ParserError:
+            # C parser fails when a later line has more fields than the first one
+            df, multifield = None, True
+        if multifield:
+            with open(args.chrord.name, 'r') as fin:
+                bad = ['line {}: "{}"'.format(i, line.strip()) for i, line in enumerate(fin, 1) if len(line.split()) > 1]
+            logger.error("{} should contain one chromosome ID per line. Found lines with more than one field: {}. Exiting.".format(args.chrord.name, ', '.join(bad)))
+            sys.exit()
+        chrs = [] if df is None else df[0].tolist()
+        bad = set(chrs) - cs
+        if len(bad) > 0:
+            bad = [c for c in dict.fromkeys(chrs) if c in bad]
+            logger.error("Chromosome {} in {} is not a chromosome in alignment file {}. Exiting.".format(', '.join(bad), args.chrord.name, alignments[0][0]))
+            sys.exit()
         # Check that the chrorder file contains all chromosomes
         if len(chrs) != len(cs):
             logger.error("Number of chromosomes in {} is different from number of chromosomes in alignment file {}. Either list the order of ALL chromosomes in CHRORD file or enter selected chromosomes after --chr. Exiting.".format(args.chrord.name, alignments[0][0]))
@@ -147,18 +181,18 @@ def plotsr(args):
 
     # chrgrps: dict. key=reference chromosome id. value=homologous chromosomes in all genomes
     chrgrps = OrderedDict()
+    chrmaps = [cid[1] for cid in chrids]
     for c in chrs:
-        cg = deque([c])
+        cg = [c]
         cur = c
-        for i in range(len(chrids)):
-            n = chrids[i][1][cur]
-            cg.append(n)
-            cur = n
+        for m in chrmaps:
+            cur = m[cur]
+            cg.append(cur)
         chrgrps[c] = cg
 
     # Filter alignments to select long alignments between homologous chromosomes
-    for i in range(len(alignments)):
-        alignments[i][1] = filterinput(args, alignments[i][1], chrids[i][1], ITX)
+    for i, df in enumerate(filterinput(args, alignments, chrids, ITX)):
+        alignments[i][1] = df
 
     # Check chromsome IDs and sizes
     chrlengths, genomes = validalign2fasta(alignments, args.genomes.name)
@@ -178,23 +212,24 @@ def plotsr(args):
             alignments[i][1] = createribbon(alignments[i][1])
 
     # invert coord for inverted query genome
+    invcodes = [VARS.index(t) for t in ['INV', 'INVTR', 'INVDP']]
     for i in range(len(alignments)):
-        df = alignments[i][1].copy()
-        invindex = ['INV' in i for i in df['type']]
-        g = set(df.loc[invindex, 'bstart'] < df.loc[invindex, 'bend'])
+        df = alignments[i][1]
+        invindex = np.isin(df['type'].cat.codes.to_numpy(), invcodes)
+        bstart = df['bstart'].to_numpy()
+        bend = df['bend'].to_numpy()
+        g = np.unique(bstart[invindex] < bend[invindex])
         if len(g) == 2:
             logger.error("Inconsistent coordinates in input file {}. For INV, INVTR, INVDUP annotations, either bstart < bend for all annotations or bstart > bend for all annotations. Mixing is not permitted. Exiting.".format(alignments[i][0]))
             sys.exit()
         elif False in g:
             continue
-        df.loc[invindex, 'bstart'] = df.loc[invindex, 'bstart'] + df.loc[invindex, 'bend']
-        df.loc[invindex, 'bend'] = df.loc[invindex, 'bstart'] - df.loc[invindex, 'bend']
-        df.loc[invindex, 'bstart'] = df.loc[invindex, 'bstart'] - df.loc[invindex, 'bend']
-        alignments[i][1] = df.copy()
+        # Swap bstart and bend for inverted annotations in a single vectorised pass
+        bstart, bend = invswap(bstart, bend, invindex)
+        alignments[i][1] = df.assign(bstart=bstart, bend=bend)
 
 
-    # from matplotlib import pyplot as plt
-    plt = matplotlib.pyplot
+    from matplotlib import pyplot as plt
     plt.rcParams['font.size'] = FS
     try:
         if H is None and W is None:
@@ -212,31 +247,36 @@ def plotsr(args):
         sys.exit()
     ax = fig.add_subplot(111, frameon=False)
 
-    # concatenated al from all alignments
-    allal = pdconcat([alignments[i][1] for i in range(len(alignments))])
+    # concatenated al from all alignments. Only the columns used for getting plot limits and legend are selected
+    allal = pdconcat([al[1][['astart', 'bstart', 'aend', 'bend', 'type']] for al in alignments], ignore_index=True)
+    # chromosome length dicts and genome count
+    chrlens = [c[1] for c in chrlengths]
+    ngen = len(chrlengths)
     if ITX:
         minl = 0
         MCHR = cfg['marginchr']
         if cfg['itxalign'] in ['L', 'R', 'C']:
             # the sum of the longer chrom from each pair
-            maxchr = sum([max([chrlengths[i][1][cid] for i, cid in enumerate(cg)]) for cg in chrgrps.values()])
+            maxchr = sum(max(chrlens[i][cid] for i, cid in enumerate(cg)) for cg in chrgrps.values())
         else:# defaulting to equidistant
             # the larger genome (larger sum of all chrom lengths from each genome)
-            maxchr = max([sum(chrlengths[i][1].values()) for i in range(len(chrlengths))])
+            maxchr = max(sum(cl.values()) for cl in chrlens)
         maxl = int(maxchr/(1 - (MCHR*(len(chrgrps) - 1))))
     elif REG is None:
         minl, maxl = 0, -1
     else:
-        minl = min(allal[['astart', 'bstart']].apply(min))
-        maxl = max(allal[['aend', 'bend']].apply(max))
+        crd = allal[['astart', 'bstart', 'aend', 'bend']].to_numpy()
+        minl = int(crd[:, :2].min())
+        maxl = int(crd[:, 2:].max())
+    sertypes = set(allal['type'].unique())
     labelcnt = 0
-    if 'SYN' in allal['type'].array:
+    if 'SYN' in sertypes:
         labelcnt += 1
-    if 'INV' in allal['type'].array:
+    if 'INV' in sertypes:
         labelcnt += 1
-    if 'TRA' in allal['type'].array or 'INVTR' in allal['type'].array:
+    if 'TRA' in sertypes or 'INVTR' in sertypes:
         labelcnt += 1
-    if 'DUP' in allal['type'].array or 'INVDP' in allal['type'].array:
+    if 'DUP' in sertypes or 'INVDP' in sertypes:
         labelcnt += 1
 
     # chromosome plotting coordinates
@@ -249,7 +289,7 @@ def plotsr(args):
     ax, indents, chrlabels = pltchrom(ax, chrs, chrgrps, chrlengths, V, S, genomes, cfg, ITX, chr_start_coord, minl=minl)
 
     if cfg['genlegcol'] < 1:
-        ncol = ceil(len(chrlengths)/labelcnt)
+        ncol = ceil(ngen/labelcnt)
     else:
         ncol = int(cfg['genlegcol'])
 
@@ -280,7 +320,13 @@ def plotsr(args):
 
     # Save the plot
     try:
-        fig.savefig(O, dpi=D, bbox_inches='tight', pad_inches=0.01)
+        # For user-defined figure size, measure the tight bounding box once on the canvas renderer. This avoids the extra layout draw that savefig performs for bbox_inches='tight'
+        if args.H is not None and args.W is not None and hasattr(fig.canvas, 'get_renderer'):
+            fig.set_dpi(D)
+            bbox = fig.get_tightbbox(fig.canvas.get_renderer()).padded(0.01)
+            fig.savefig(O, dpi=D, bbox_inches=bbox)
+        else:
+            fig.savefig(O, dpi=D, bbox_inches='tight', pad_inches=0.01)
         logger.info("Plot {O} generated.".format(O=O))
     except Exception as e:
         sys.exit('Error in saving the figure. Try using a different backend.' + '\n' + e.with_traceback())
@@ -288,7 +334,7 @@ def plotsr(args):
 # END
 
 def main():
-    from matplotlib.rcsetup import non_interactive_bk as bklist
+    bklist = LazyBackends()
     parser = argparse.ArgumentParser("Plotting structural rearrangements between genomes", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     other = parser._action_groups.pop()
     inputfiles = parser.add_argument_group("Input/Output files")
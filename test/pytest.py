@@ -60,6 +60,91 @@ class TestHometools(unittest.TestCase):
                     raise
 
 
+class TestReaders(unittest.TestCase):
+    syrilines = ['Chr4\t1400\t1571473\t-\t-\tOX291574.1\t362048\t2009922\tSYN1\t-\tSYN\t-',
+                 'Chr4\t1800000\t1850000\t-\t-\tOX291574.1\t2100000\t2150000\tINV1\t-\tINV\t-',
+                 'Chr4\t1800000\t1800010\tA\tT\tOX291574.1\t2100000\t2100000\t-\tSYN1\tSNP\t-']
+    bedlines = ['Chr4\t1399\t1571473\tOX291574.1\t362047\t2009922\tSYN',
+                'Chr4\t1799999\t1850000\tOX291574.1\t2099999\t2150000\tINV']
+
+    def readlines(self, readfun, lines):
+        import tempfile
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as fout:
+            fout.write('\n'.join(lines) + '\n')
+        try:
+            return readfun(fout.name)
+        finally:
+            os.remove(fout.name)
+
+    def test_syri_extra_columns(self):
+        from plotsr.scripts.func import readsyriout
+        df, chrid = self.readlines(readsyriout, self.syrilines)
+        dfx, chridx = self.readlines(readsyriout, [l + '\tx\ty' for l in self.syrilines])
+        assert df.equals(dfx)
+        assert chrid == chridx == {'Chr4': 'OX291574.1'}
+        assert df['astart'].tolist() == [1400, 1800000]
+        assert df['anno'].tolist() == ['-', '-']
+
+    def test_syri_annotation_column(self):
+        from plotsr.scripts.func import readsyriout
+        df, _ = self.readlines(readsyriout, [self.syrilines[0] + '\tlw:2', self.syrilines[1]])
+        assert df['type'].tolist() == ['SYN', 'INV']
+        assert df['anno'].tolist() == ['lw:2', '-']
+
+    def test_bedpe_extra_columns(self):
+        from plotsr.scripts.func import readbedout
+        df, chrid = self.readlines(readbedout, self.bedlines)
+        dfx, chridx = self.readlines(readbedout, [l + '\tx\ty' for l in self.bedlines])
+        assert df.equals(dfx)
+        assert chrid == chridx == {'Chr4': 'OX291574.1'}
+        assert df['astart'].tolist() == [1400, 1800000]
+        assert df['anno'].tolist() == ['-', '-']
+
+    def test_bedpe_annotation_column(self):
+        from plotsr.scripts.func import readbedout
+        df, _ = self.readlines(readbedout, [self.bedlines[0], self.bedlines[1] + '\tlw:2'])
+        assert df['type'].tolist() == ['SYN', 'INV']
+        assert df['anno'].tolist() == ['-', 'lw:2']
+
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+@unittest.skipUnless(numba is not None, 'numba is not installed')
+class TestNumbaKernels(unittest.TestCase):
+    def setUp(self):
+        import plotsr.scripts.func as func
+        self.func = func
+        self.minrows = func.NUMBA_MINROWS
+        func.NUMBA_MINROWS = 0
+
+    def tearDown(self):
+        self.func.NUMBA_MINROWS = self.minrows
+
+    def test_lenfilter(self):
+        import numpy as np
+        rng = np.random.default_rng(0)
+        astart, bstart = rng.integers(1, 100000, (2, 1000))
+        aend, bend = astart + rng.integers(0, 20000, 1000), bstart + rng.integers(0, 20000, 1000)
+        tcode = rng.integers(0, len(self.func.VARS), 1000).astype(np.int8)
+        syncode = self.func.VARS.index('SYN')
+        keep = self.func.lenfilter(astart, aend, bstart, bend, tcode, 10000)
+        assert np.array_equal(keep, ((aend - astart) >= 10000) | ((bend - bstart) >= 10000) | (tcode == syncode))
+
+    def test_invswap(self):
+        import numpy as np
+        rng = np.random.default_rng(0)
+        bstart = rng.integers(1, 100000, 1000)
+        bend = bstart + rng.integers(0, 20000, 1000)
+        invindex = rng.random(1000) < 0.3
+        bs, be = self.func.invswap(bstart, bend, invindex)
+        assert np.array_equal(bs, np.where(invindex, bend, bstart))
+        assert np.array_equal(be, np.where(invindex, bstart, bend))
+
+
 if __name__ == '__main__':
     pytest_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'test_data'))
     os.chdir(pytest_dir)